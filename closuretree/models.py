@@ -26,13 +26,53 @@
 # Public methods are useful!
 # pylint: disable=R0904
 
-from django.db import models
+from django import VERSION
+from django.db import connections, models, router, transaction
 from django.db.models.base import ModelBase
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 from django.utils.six import with_metaclass
+from operator import attrgetter
 import sys
 
+# Raw SQL run against the closure tables, see ClosureModel._closure_sql.
+_CLOSURE_SQL = {
+    'createlink': (
+        "INSERT INTO {table} ({parent}, {child}, {depth}) "
+        "SELECT p.{parent}, c.{child}, p.{depth} + c.{depth} + 1 "
+        "FROM {table} p, {table} c "
+        "WHERE p.{child} = %s AND c.{parent} = %s"
+    ),
+    'isdescendant': (
+        "SELECT 1 FROM {table} WHERE {parent} = %s AND {child} = %s"
+    ),
+    'deletelink': (
+        "DELETE FROM {table} "
+        "WHERE {parent} IN (SELECT {parent} FROM {table} WHERE {child} = %s) "
+        "AND {child} IN (SELECT {child} FROM {table} WHERE {parent} = %s)"
+    ),
+    'deletelink_join': (
+        "DELETE l FROM {table} l "
+        "INNER JOIN {table} a ON a.{parent} = l.{parent} "
+        "INNER JOIN {table} d ON d.{child} = l.{child} "
+        "WHERE a.{child} = %s AND d.{parent} = %s"
+    ),
+    'createnode': (
+        "INSERT INTO {table} ({parent}, {child}, {depth}) "
+        "SELECT {node_pk}, {node_pk}, 0 FROM {node_table} "
+        "WHERE {node_pk} = %s "
+        "UNION ALL SELECT {parent}, %s, {depth} + 1 "
+        "FROM {table} WHERE {child} = %s"
+    ),
+}
+
+def _closure_transaction(using):
+    """A transaction for closure changes that must happen together."""
+    if VERSION >= (1, 6):
+        return transaction.atomic(using=using, savepoint=False)
+    return transaction.commit_on_success(using=using)
+
 def _closure_model_unicode(self):
     """__unicode__ implementation for the dynamically created
         <Model>Closure model.
@@ -41,24 +81,28 @@ def _closure_model_unicode(self):
 
 def create_closure_model(cls):
     """Creates a <Model>Closure model in the same module as the model."""
-    meta_vals = {
-        'unique_together':  (("parent", "child"),)
-    }
+    class Meta(object):
+        """Options for the closure model."""
+        # pylint: disable=R0903
+        unique_together = (("parent", "child"),)
     if getattr(cls._meta, 'db_table', None):
-        meta_vals['db_table'] = '%sclosure' % getattr(cls._meta, 'db_table')
+        Meta.db_table = '%sclosure' % cls._meta.db_table
+    # The model already exists, so refer to it directly rather than by
+    # name and save django resolving the relation lazily.
     model = type('%sClosure' % cls.__name__, (models.Model,), {
         'parent': models.ForeignKey(
-            cls.__name__,
+            cls,
             related_name=cls.closure_parentref()
         ),
         'child': models.ForeignKey(
-            cls.__name__,
+            cls,
             related_name=cls.closure_childref()
         ),
         'depth': models.IntegerField(),
         '__module__':   cls.__module__,
         '__unicode__': _closure_model_unicode,
-        'Meta': type('Meta', (object,), meta_vals),
+        '_closure_sql_cache': {},
+        'Meta': Meta,
     })
     setattr(cls, "_closure_model", model)
     return model
@@ -73,7 +117,68 @@ class ClosureModelBase(ModelBase):
             to doing all the normal django stuff.
         """
         super(ClosureModelBase, cls).__init__(name, bases, dct)
-        if not cls._meta.get_parent_list() and cls.__module__ != __name__:
+        # Resolve the ClosureMeta options once, they're needed on every
+        # attribute assignment and tree walk.
+        meta = getattr(cls, 'ClosureMeta', None)
+        cls._closure_parent_attr = getattr(meta, 'parent_attr', 'parent')
+        cls._closure_parent_id_attr = "%s_id" % cls._closure_parent_attr
+        cls._closure_sentinel_attr = getattr(
+            meta, 'sentinel_attr', cls._closure_parent_attr
+        )
+        cls._closure_watched_names = frozenset([
+            cls._closure_sentinel_attr, "%s_id" % cls._closure_sentinel_attr
+        ])
+        if cls.__module__ == __name__:
+            return
+        superclasses = (
+            set(ClosureModel.__subclasses__()) &
+            set(cls._meta.get_parent_list())
+        )
+        cls._closure_toplevel = (
+            next(iter(superclasses)) if superclasses else cls
+        )
+        # Whether children can be found straight from the parent field,
+        # rather than it being a property that needs the closure table.
+        try:
+            cls._closure_toplevel._meta.get_field(cls._closure_parent_attr)
+        except FieldDoesNotExist:
+            cls._closure_parent_is_field = False
+        else:
+            cls._closure_parent_is_field = True
+        # Integer keys can be handed to the database as they are, others
+        # (UUIDs, for instance) need converting by the field first.
+        cls._closure_convert_pks = not isinstance(
+            cls._closure_toplevel._meta.pk, models.AutoField
+        )
+        toplevel_name = cls._closure_toplevel.__name__.lower()
+        cls._closure_parentref_name = "%sclosure_children" % toplevel_name
+        cls._closure_childref_name = "%sclosure_parents" % toplevel_name
+        # The lookups get_ancestors and get_descendants filter with.
+        cls._closure_ancestor_lookup = (
+            "%s__child" % cls._closure_parentref_name
+        )
+        cls._closure_ancestor_depth_lookup = (
+            "%s__depth__lte" % cls._closure_parentref_name
+        )
+        cls._closure_ancestor_mindepth_lookup = (
+            "%s__depth__gte" % cls._closure_parentref_name
+        )
+        cls._closure_ancestor_order = (
+            "%s__depth" % cls._closure_parentref_name
+        )
+        cls._closure_descendant_lookup = (
+            "%s__parent" % cls._closure_childref_name
+        )
+        cls._closure_descendant_depth_lookup = (
+            "%s__depth__lte" % cls._closure_childref_name
+        )
+        cls._closure_descendant_mindepth_lookup = (
+            "%s__depth__gte" % cls._closure_childref_name
+        )
+        cls._closure_descendant_order = (
+            "%s__depth" % cls._closure_childref_name
+        )
+        if not cls._meta.get_parent_list():
             setattr(
                 sys.modules[cls.__module__],
                 '%sClosure' % cls.__name__,
@@ -91,12 +196,15 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
         abstract = True
 
     def __setattr__(self, name, value):
+        if name not in self._closure_watched_names:
+            # Most assignments aren't to the attribute we're watching.
+            super(ClosureModel, self).__setattr__(name, value)
+            return
         if name.endswith('_id'):
             id_field_name = name
         else:
             id_field_name = "%s_id" % name
         if (
-            name.startswith(self._closure_sentinel_attr) and  # It's the right attribute
             hasattr(self, id_field_name) and  # It's already been set
             not self._closure_change_check()  # The old value isn't stored
         ):
@@ -121,28 +229,45 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
             C inheriting from B inheriting from A inheriting from ClosureModel
             C._toplevel() will return A.
         """
-        superclasses = (
-            list(set(ClosureModel.__subclasses__()) &
-                 set(cls._meta.get_parent_list()))
-        )
-        return next(iter(superclasses)) if superclasses else cls
+        return cls._closure_toplevel
 
     @classmethod
     def rebuildtable(cls):
         """Regenerate the entire closuretree."""
+        # Work out every link in python from the parent pointers, rather
+        # than asking the closure table for each node's ancestors in turn.
+        if cls._closure_parent_is_field:
+            parents = dict(cls.objects.values_list(
+                'pk', cls._closure_parent_id_attr
+            ).iterator())
+        else:
+            # A parent property can only be worked out from the node itself.
+            parents = dict(
+                (node.pk, node._closure_parent_pk)
+                for node in cls.objects.iterator()
+            )
+        links = []
+        for pk in parents:
+            ancestor, depth = pk, 0
+            while ancestor is not None:
+                if depth > len(parents):
+                    # Only a loop in the parents can make a chain this long.
+                    raise ValueError(
+                        "The ancestors of %s contain a cycle" % pk
+                    )
+                links.append(cls._closure_model(
+                    parent_id=ancestor,
+                    child_id=pk,
+                    depth=depth
+                ))
+                ancestor, depth = parents.get(ancestor), depth + 1
         cls._closure_model.objects.all().delete()
-        cls._closure_model.objects.bulk_create([cls._closure_model(
-            parent_id=x['pk'],
-            child_id=x['pk'],
-            depth=0
-        ) for x in cls.objects.values("pk")])
-        for node in cls.objects.all():
-            node._closure_createlink()
+        cls._closure_model.objects.bulk_create(links)
 
     @classmethod
     def closure_parentref(cls):
         """How to refer to parents in the closure tree"""
-        return "%sclosure_children" % cls._toplevel().__name__.lower()
+        return cls._closure_parentref_name
 
     # Backwards compatibility:
     _closure_parentref = closure_parentref
@@ -150,60 +275,110 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
     @classmethod
     def closure_childref(cls):
         """How to refer to children in the closure tree"""
-        return "%sclosure_parents" % cls._toplevel().__name__.lower()
+        return cls._closure_childref_name
 
     # Backwards compatibility:
     _closure_childref = closure_childref
 
-    @property
-    def _closure_sentinel_attr(self):
-        """The attribute we need to watch to tell if the
-            parent/child relationships have changed
-        """
-        meta = getattr(self, 'ClosureMeta', None)
-        return getattr(meta, 'sentinel_attr', self._closure_parent_attr)
+    @classmethod
+    def _closure_sql(cls, connection, name):
+        """The named statement from _CLOSURE_SQL for our closure table.
 
-    @property
-    def _closure_parent_attr(self):
-        '''The attribute or property that holds the parent object.'''
-        meta = getattr(self, 'ClosureMeta', None)
-        return getattr(meta, 'parent_attr', 'parent')
+            Statements only depend on the table and the quoting rules, so
+            they're built once per database vendor.
+        """
+        cache = cls._closure_model._closure_sql_cache
+        key = (connection.vendor, name)
+        if key not in cache:
+            qn = connection.ops.quote_name
+            opts = cls._closure_model._meta
+            node_opts = cls._toplevel()._meta
+            cache[key] = _CLOSURE_SQL[name].format(
+                node_table=qn(node_opts.db_table),
+                node_pk=qn(node_opts.pk.column),
+                table=qn(opts.db_table),
+                parent=qn(opts.get_field('parent').column),
+                child=qn(opts.get_field('child').column),
+                depth=qn(opts.get_field('depth').column),
+            )
+        return cache[key]
 
     @property
     def _closure_parent_pk(self):
         """What our parent pk is in the closure tree."""
-        if hasattr(self, "%s_id" % self._closure_parent_attr):
-            return getattr(self, "%s_id" % self._closure_parent_attr)
-        else:
+        try:
+            return getattr(self, self._closure_parent_id_attr)
+        except AttributeError:
             parent = getattr(self, self._closure_parent_attr)
             return parent.pk if parent else None
 
     def _closure_deletelink(self, oldparentpk):
-        """Remove incorrect links from the closure tree."""
-        self._closure_model.objects.filter(
-            **{
-                "parent__%s__child" % self._closure_parentref(): oldparentpk,
-                "child__%s__parent" % self._closure_childref(): self.pk
-            }
-        ).delete()
+        """Remove incorrect links from the closure tree.
+
+            Like the other closure writes this is raw SQL, so the deleted
+            <Model>Closure rows don't send pre_delete/post_delete.
+        """
+        # Only the links from our old ancestors into our subtree go, the
+        # ones within the subtree are still right wherever it ends up.
+        using = router.db_for_write(self._closure_model, instance=self)
+        if connections[using].features.update_can_self_select:
+            name = 'deletelink'
+        else:
+            # MySQL can't delete from a table it's selecting from in a
+            # subquery, but it can join the table to itself.
+            name = 'deletelink_join'
+        self._closure_execute(name, [oldparentpk, self.pk])
 
     def _closure_createlink(self):
         """Create a link in the closure tree."""
-        linkparents = self._closure_model.objects.filter(
-            child__pk=self._closure_parent_pk
-        ).values("parent", "depth")
-        linkchildren = self._closure_model.objects.filter(
-            parent__pk=self.pk
-        ).values("child", "depth")
-        newlinks = [self._closure_model(
-            parent_id=p['parent'],
-            child_id=c['child'],
-            depth=p['depth']+c['depth']+1
-        ) for p in linkparents for c in linkchildren]
-        self._closure_model.objects.bulk_create(newlinks)
-
-    def get_ancestors(self, include_self=False, depth=None):
-        """Return all the ancestors of this object."""
+        parentpk = self._closure_parent_pk
+        if parentpk is None:
+            return
+        # Link every ancestor of our parent to every one of our descendants
+        # with a single INSERT ... SELECT, rather than pulling both sides
+        # back into python first.
+        self._closure_execute('createlink', [parentpk, self.pk])
+
+    def _closure_createnode(self):
+        """Create the links for a node that has just been made."""
+        # We're our own only descendant, so there's no need to look our
+        # descendants up: add our own link and one for each of our parent's
+        # ancestors in the same statement.
+        self._closure_execute(
+            'createnode', [self.pk, self.pk, self._closure_parent_pk]
+        )
+
+    def _closure_execute(self, name, pks, read=False):
+        """Run a statement from _CLOSURE_SQL against our closure table,
+            with the node pks `pks` as its parameters.
+            Returns the first row, for statements that are queries.
+        """
+        closure = self._closure_model
+        if read:
+            using = router.db_for_read(closure, instance=self)
+        else:
+            using = router.db_for_write(closure, instance=self)
+        connection = connections[using]
+        if self._closure_convert_pks:
+            field = closure._meta.get_field('child')
+            pks = [field.get_db_prep_save(pk, connection) for pk in pks]
+        cursor = connection.cursor()
+        try:
+            cursor.execute(self._closure_sql(connection, name), pks)
+            row = cursor.fetchone() if read else None
+        finally:
+            cursor.close()
+        if not read and VERSION < (1, 6):
+            # Without autocommit, raw writes aren't committed for us.
+            transaction.commit_unless_managed(using=using)
+        return row
+
+    def get_ancestors(self, include_self=False, depth=None, order=True):
+        """Return all the ancestors of this object.
+
+            Nearest first, unless `order` is False, which saves the database
+            sorting them.
+        """
         if self.is_root_node():
             if not include_self:
                 return self._toplevel().objects.none()
@@ -211,32 +386,44 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
                 # Filter on pk for efficiency.
                 return self._toplevel().objects.filter(pk=self.pk)
 
-        params = {"%s__child" % self._closure_parentref():self.pk}
+        params = {self._closure_ancestor_lookup: self.pk}
         if depth is not None:
-            params["%s__depth__lte" % self._closure_parentref()] = depth
-        ancestors = self._toplevel().objects.filter(**params)
+            params[self._closure_ancestor_depth_lookup] = depth
         if not include_self:
-            ancestors = ancestors.exclude(pk=self.pk)
-        return ancestors.order_by("%s__depth" % self._closure_parentref())
+            # Only our own link has depth 0; dropping it inside the join
+            # means the database never pairs it up with our row.
+            params[self._closure_ancestor_mindepth_lookup] = 1
+        ancestors = self._toplevel().objects.filter(**params)
+        if not order:
+            return ancestors
+        return ancestors.order_by(self._closure_ancestor_order)
+
+    def get_descendants(self, include_self=False, depth=None, order=True):
+        """Return all the descendants of this object.
 
-    def get_descendants(self, include_self=False, depth=None):
-        """Return all the descendants of this object."""
-        params = {"%s__parent" % self._closure_childref():self.pk}
+            Nearest first, unless `order` is False, which saves the database
+            sorting them.
+        """
+        params = {self._closure_descendant_lookup: self.pk}
         if depth is not None:
-            params["%s__depth__lte" % self._closure_childref()] = depth
-        descendants = self._toplevel().objects.filter(**params)
+            params[self._closure_descendant_depth_lookup] = depth
         if not include_self:
-            descendants = descendants.exclude(pk=self.pk)
-        return descendants.order_by("%s__depth" % self._closure_childref())
+            params[self._closure_descendant_mindepth_lookup] = 1
+        descendants = self._toplevel().objects.filter(**params)
+        if not order:
+            return descendants
+        return descendants.order_by(self._closure_descendant_order)
 
     def prepopulate(self, queryset):
         """Perpopulate a descendants query's children efficiently.
             Call like: blah.prepopulate(blah.get_descendants().select_related(stuff))
         """
         objs = list(queryset)
-        hashobjs = dict([(x.pk, x) for x in objs] + [(self.pk, self)])
-        for descendant in hashobjs.values():
+        self._cached_children = []
+        hashobjs = {self.pk: self}
+        for descendant in objs:
             descendant._cached_children = []
+            hashobjs[descendant.pk] = descendant
         for descendant in objs:
             assert descendant._closure_parent_pk in hashobjs
             parent = hashobjs[descendant._closure_parent_pk]
@@ -245,13 +432,30 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
     def get_children(self):
         """Return all the children of this object."""
         if hasattr(self, '_cached_children'):
-            children = self._toplevel().objects.filter(
-                pk__in=[n.pk for n in self._cached_children]
-            )
-            children._result_cache = self._cached_children
+            # Build the queryset once per prepopulate rather than on every
+            # call. The filter keeps it usable if it's refined further.
+            children = getattr(self, '_cached_children_queryset', None)
+            if (
+                children is None or
+                children._result_cache is not self._cached_children
+            ):
+                children = self._toplevel().objects.filter(
+                    pk__in=map(attrgetter('pk'), self._cached_children)
+                )
+                children._result_cache = self._cached_children
+                children._prefetch_done = True
+                self._cached_children_queryset = children
             return children
-        else:
-            return self.get_descendants(include_self=False, depth=1)
+        if self.pk is None:
+            return self._toplevel().objects.none()
+        if not self._closure_parent_is_field:
+            # The parent is found indirectly, only the closure table knows.
+            return self.get_descendants(
+                include_self=False, depth=1, order=False
+            )
+        return self._toplevel().objects.filter(
+            **{self._closure_parent_attr: self.pk}
+        )
 
     def get_root(self):
         """Return the furthest ancestor of this node."""
@@ -259,9 +463,35 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
             return self
 
         return self.get_ancestors().order_by(
-            "-%s__depth" % self._closure_parentref()
+            "-%s" % self._closure_ancestor_order
         )[0]
 
+    @classmethod
+    def get_roots_for(cls, pks):
+        """Return a dict mapping each of `pks` to the furthest ancestor
+            of that node.
+
+            Use this rather than calling get_root on lots of nodes, it
+            only needs one query however many nodes there are (two when
+            the parent is a property).
+        """
+        if cls._closure_parent_is_field:
+            # The root is the one ancestor without a parent of its own.
+            links = cls._closure_model.objects.filter(
+                child__in=pks,
+                **{'parent__%s__isnull' % cls._closure_parent_attr: True}
+            ).select_related('parent')
+            return dict((link.child_id, link.parent) for link in links)
+        links = cls._closure_model.objects.filter(
+            child__in=pks
+        ).order_by('depth').values_list('child', 'parent')
+        # Ordered by depth, so the root is the last parent we see.
+        rootpks = dict(links)
+        roots = cls._toplevel().objects.in_bulk(set(rootpks.values()))
+        return dict(
+            (child, roots[parent]) for child, parent in rootpks.items()
+        )
+
     def is_child_node(self):
         """Is this node a child, i.e. has a parent?"""
         return not self.is_root_node()
@@ -275,10 +505,11 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
         if other.pk == self.pk:
             return include_self
 
-        return self._closure_model.objects.filter(
-            parent=other,
-            child=self
-        ).exclude(pk=self.pk).exists()
+        # parent/child is unique, so there's at most one row to find.
+        row = self._closure_execute(
+            'isdescendant', [other.pk, self.pk], read=True
+        )
+        return row is not None
 
     def is_ancestor_of(self, other, include_self=False):
         """Is this node an ancestor of `other`?"""
@@ -303,23 +534,23 @@ class ClosureModel(with_metaclass(ClosureModelBase, models.Model)):
 def closure_model_save(sender, **kwargs):
     if issubclass(sender, ClosureModel):
         instance = kwargs['instance']
-        create = kwargs['created']
-        if create:
-            closure_instance = instance._closure_model(
-                parent=instance,
-                child=instance,
-                depth=0
+        if kwargs['created']:
+            # A brand new node can't have any descendants yet
+            instance._closure_createnode()
+        elif instance._closure_change_check():
+            #Changed parents.
+            using = router.db_for_write(
+                instance._closure_model, instance=instance
             )
-            closure_instance.save()
+            # Don't leave the old links deleted if the new ones can't be made
+            with _closure_transaction(using):
+                if instance._closure_change_oldparent():
+                    instance._closure_deletelink(
+                        instance._closure_change_oldparent()
+                    )
+                instance._closure_createlink()
         if instance._closure_change_check():
-            #Changed parents.
-            if instance._closure_change_oldparent():
-                instance._closure_deletelink(instance._closure_change_oldparent())
-            instance._closure_createlink()
             delattr(instance, "_closure_old_parent_pk")
-        elif create:
-            # We still need to create links when we're first made
-            instance._closure_createlink()
 
 
 @receiver(pre_delete, dispatch_uid='closure-model-delete')
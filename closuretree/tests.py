@@ -24,8 +24,8 @@
 # pylint: disable=
 
 from django import VERSION
-from django.test import TestCase
-from django.db import models
+from django.test import TestCase, TransactionTestCase
+from django.db import IntegrityError, models
 from closuretree.models import ClosureModel
 import uuid
 
@@ -118,6 +118,47 @@ class BaseTestCase(TestCase):
         self.b.delete()
         self.failUnlessEqual(self.closure_model.objects.count(), 2)
 
+    def test_rebuild(self):
+        """
+            Tests that rebuilding recreates the closures.
+        """
+        self.b.parent2 = self.a
+        self.b.save()
+        self.c.parent2 = self.b
+        self.c.save()
+        self.closure_model.objects.all().delete()
+        self.normal_model.rebuildtable()
+        self.failUnlessEqual(self.closure_model.objects.count(), 7)
+        self.failUnlessEqual(
+            self.closure_model.objects.get(parent=self.a, child=self.c).depth,
+            2
+        )
+
+    def test_moving_subtree(self):
+        """
+            Tests that moving a node takes its descendants along with it.
+        """
+        self.b.parent2 = self.a
+        self.b.save()
+        self.c.parent2 = self.b
+        self.c.save()
+        self.d.parent2 = self.a
+        self.d.save()
+        self.b.parent2 = self.d
+        self.b.save()
+        self.failUnlessEqual(self.closure_model.objects.count(), 10)
+        self.failUnlessEqual(
+            self.closure_model.objects.get(parent=self.a, child=self.c).depth,
+            3
+        )
+        self.failUnlessEqual(
+            self.closure_model.objects.get(parent=self.d, child=self.c).depth,
+            2
+        )
+        self.failUnless(self.c.is_descendant_of(self.d))
+        e = self.normal_model.objects.create(name="e")
+        self.failIf(self.c.is_descendant_of(e))
+
 
 if VERSION >= (1, 8):
     class UUIDTC(ClosureModel):
@@ -187,10 +228,23 @@ class AncestorTestCase(TestCase):
             [self.c]
         )
 
+    def test_unordered(self):
+        """Testing the ancestors and descendants without ordering."""
+        self.failIf(self.a.get_descendants(order=False).ordered)
+        self.failUnlessEqual(
+            set(self.a.get_descendants(order=False)), set([self.b, self.c])
+        )
+        self.failIf(self.c.get_ancestors(order=False).ordered)
+        self.failUnlessEqual(
+            set(self.c.get_ancestors(include_self=True, order=False)),
+            set([self.a, self.b, self.c])
+        )
+
     def test_children(self):
         """Testing the children method."""
         self.failUnlessEqual(list(self.c.get_children()), [])
         self.failUnlessEqual(list(self.b.get_children()), [self.c])
+        self.failUnlessEqual(list(TC(name="x").get_children()), [])
 
 class RebuildTestCase(TestCase):
     """Test rebuilding the tree"""
@@ -230,6 +284,85 @@ class RebuildTestCase(TestCase):
         TC.rebuildtable()
         self.failUnlessEqual(TCClosure.objects.count(), 8)
 
+    def test_rebuild_depths(self):
+        """Test a rebuild recreates the links at the right depths."""
+
+        TCClosure.objects.all().delete()
+        TC.rebuildtable()
+        self.failUnlessEqual(
+            TCClosure.objects.get(parent=self.a, child=self.c).depth, 2
+        )
+        self.failUnlessEqual(
+            TCClosure.objects.get(parent=self.a, child=self.d).depth, 1
+        )
+        self.failUnlessEqual(
+            TCClosure.objects.get(parent=self.c, child=self.c).depth, 0
+        )
+
+    def test_rebuild_cycle(self):
+        """Test a rebuild refuses parents that loop back on themselves."""
+
+        TC.objects.filter(pk=self.a.pk).update(parent2=self.c)
+        self.assertRaises(ValueError, TC.rebuildtable)
+        self.failUnlessEqual(TCClosure.objects.count(), 8)
+
+    def test_rebuild_many_links(self):
+        """Test a rebuild needing more than one insert statement."""
+
+        parent = self.d
+        for i in range(30):
+            parent = TC.objects.create(name=str(i), parent2=parent)
+        count = TCClosure.objects.count()
+        TCClosure.objects.all().delete()
+        TC.rebuildtable()
+        self.failUnlessEqual(TCClosure.objects.count(), count)
+        self.failUnlessEqual(
+            TCClosure.objects.get(parent=self.a, child=parent).depth, 31
+        )
+
+class MoveTestCase(TestCase):
+    """Test moving a subtree to a new parent."""
+
+    def setUp(self):
+        self.a = TC.objects.create(name="a")
+        self.b = TC.objects.create(name="b", parent2=self.a)
+        self.c = TC.objects.create(name="c", parent2=self.b)
+        self.d = TC.objects.create(name="d")
+
+    def test_subtree_links_kept(self):
+        """Test links inside the moved subtree are left alone."""
+        inner = TCClosure.objects.get(parent=self.b, child=self.c)
+        # Saving the node is an UPDATE, before 1.6 with a SELECT first,
+        # then one DELETE and one INSERT against the closure table.
+        with self.assertNumQueries(3 if VERSION >= (1, 6) else 4):
+            self.b.parent2 = self.d
+            self.b.save()
+        self.failUnlessEqual(
+            TCClosure.objects.get(parent=self.b, child=self.c), inner
+        )
+        self.failIf(TCClosure.objects.filter(parent=self.a).exclude(
+            child=self.a
+        ).exists())
+        self.failUnlessEqual(
+            TCClosure.objects.get(parent=self.d, child=self.c).depth, 2
+        )
+
+class FailedMoveTestCase(TransactionTestCase):
+    """Test a move that can't be completed."""
+
+    def test_closures_untouched(self):
+        """Test the closures stay as they were if a move fails."""
+        a = TC.objects.create(name="a")
+        b = TC.objects.create(name="b", parent2=a)
+        c = TC.objects.create(name="c", parent2=b)
+        links = set(TCClosure.objects.values_list('parent', 'child', 'depth'))
+        b.parent2 = c
+        self.assertRaises(IntegrityError, b.save)
+        self.failUnlessEqual(
+            set(TCClosure.objects.values_list('parent', 'child', 'depth')),
+            links
+        )
+
 class InitialClosureTestCase(TestCase):
     """Tests for when things are created with a parent."""
 
@@ -242,6 +375,13 @@ class InitialClosureTestCase(TestCase):
         TC.objects.create(name="c", parent2=b)
         self.failUnlessEqual(TCClosure.objects.count(), 6)
 
+    def test_creating_num_queries(self):
+        """Make sure a new node's closures are made in one query."""
+        a = TC.objects.create(name="a")
+        with self.assertNumQueries(2):
+            TC.objects.create(name="b", parent2=a)
+        self.failUnlessEqual(TCClosure.objects.count(), 3)
+
 class IsTestCase(TestCase):
     """Test some useful methods."""
 
@@ -289,6 +429,20 @@ class IsTestCase(TestCase):
         self.assertEqual(self.b.get_root(), self.a)
         self.assertEqual(self.f.get_root(), self.a)
 
+    def test_get_roots_for(self):
+        """Test get_roots_for method"""
+        other = TC.objects.create(name="other")
+        with self.assertNumQueries(1):
+            roots = TC.get_roots_for(
+                [self.a.pk, self.c.pk, self.f.pk, other.pk]
+            )
+        self.assertEqual(roots, {
+            self.a.pk: self.a,
+            self.c.pk: self.a,
+            self.f.pk: self.a,
+            other.pk: other,
+        })
+
     def test_child_node(self):
         """Test is_child_node method"""
         self.assertEqual(self.a.is_child_node(), False)
@@ -321,6 +475,23 @@ class PrepopulateTestCase(TestCase):
                 children.extend(list(node.get_children()))
             self.assertEqual(len(children), 4)
 
+    def test_prepopulate_filter(self):
+        """Test refining prepopulated children still queries them"""
+        queryset = self.a.get_descendants()
+        self.a.prepopulate(queryset)
+        children = queryset[0].get_children()
+        self.assertEqual(list(children), [self.c, self.e])
+        self.assertEqual(list(children.filter(name="e")), [self.e])
+
+    def test_prepopulate_children_reused(self):
+        """Test prepopulated children don't need rebuilding each call"""
+        queryset = self.a.get_descendants()
+        self.a.prepopulate(queryset)
+        node = queryset[0]
+        with self.assertNumQueries(0):
+            self.assertTrue(node.get_children() is node.get_children())
+            self.assertEqual(list(node.get_children()), [self.c, self.e])
+
     def test_prepopulate_not_root(self):
         """Test prepopulating when we're not the root"""
         with self.assertNumQueries(5):
@@ -390,6 +561,40 @@ class SentinelAttributeTestCase(TestCase):
 
         self.failUnlessEqual(SentinelModelClosure.objects.count(), 7)
 
+    def test_children(self):
+        '''Test finding children through the sentinel attribute'''
+        self.b.location = self.l1
+        self.b.save()
+        self.c.location = self.l1
+        self.c.save()
+        self.failUnlessEqual(
+            set(self.a.get_children()), set([self.b, self.c])
+        )
+        self.failUnlessEqual(list(self.b.get_children()), [])
+
+    def test_get_roots_for(self):
+        '''Test finding roots through the parent property'''
+        self.b.location = self.l1
+        self.b.save()
+        self.c.location = self.l2
+        self.c.save()
+        with self.assertNumQueries(2):
+            roots = SentinelModel.get_roots_for([self.a.pk, self.c.pk])
+        self.failUnlessEqual(roots, {self.a.pk: self.a, self.c.pk: self.a})
+
+    def test_rebuild(self):
+        '''Test rebuilding the tree through the parent property'''
+        self.b.location = self.l1
+        self.b.save()
+        self.c.location = self.l2
+        self.c.save()
+        SentinelModelClosure.objects.all().delete()
+        SentinelModel.rebuildtable()
+        self.failUnlessEqual(SentinelModelClosure.objects.count(), 7)
+        self.failUnlessEqual(SentinelModelClosure.objects.get(
+            parent=self.a, child=self.c
+        ).depth, 2)
+
     def test_num_queries(self):
         '''Test that we don't need to access the objects until we make a change.'''
         self.b.location = self.l1